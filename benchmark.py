@@ -4,12 +4,27 @@ Benchmark script for Mock Engine
 Tests performance with different token generation speeds
 """
 
+import argparse
+import asyncio
+import atexit
+import hashlib
+import math
+import os
+import shelve
+import shutil
+import socket
 import subprocess
 import time
-import json
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
+import orjson
+import requests
+from prometheus_client.parser import text_string_to_metric_families
+from requests.adapters import HTTPAdapter
+
 # Test queries
 GREP_QUERIES = [
     "search for class definitions",
@@ -30,50 +45,108 @@ TOKEN_CONFIGS = [
     {"prefill": 10000000, "decode": 10000000, "name": "Instant"},
 ]
 
-def update_mock_engine_speeds(prefill_speed, decode_speed):
-    """Update token speeds in mock_engine.py"""
-    mock_engine_path = Path("mock_engine.py")
-    
-    if not mock_engine_path.exists():
-        print("❌ Error: mock_engine.py not found in current directory")
+# Where mock_engine.py listens
+MOCK_ENGINE_HOST = "127.0.0.1"
+MOCK_ENGINE_PORT = 8000
+MOCK_ENGINE_URL = f"http://{MOCK_ENGINE_HOST}:{MOCK_ENGINE_PORT}"
+
+# Absolute path of the qwen CLI, resolved once instead of on every exec
+QWEN = shutil.which('qwen')
+
+# Separates queries (and their answers) in a batched qwen run. This assumes
+# `qwen -p -` reads every prompt from stdin and echoes the delimiter between
+# answers; it is not a documented qwen contract, so output that doesn't split
+# into exactly one answer per query aborts the run instead of being measured
+BATCH_DELIMITER = "\n---\n"
+
+# Final summary, plus one line per config written as soon as it finishes
+OUTPUT_FILE = "benchmark_results.json"
+STREAM_FILE = "benchmark_results.jsonl"
+
+# Outcome cache shared across runs (--cache)
+CACHE_FILE = "bench_cache.db"
+
+# One pooled session so every query reuses the same TCP connection
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=16))
+
+def set_mock_engine_speeds(prefill_speed, decode_speed):
+    """Switch the running mock-engine to new token speeds"""
+    try:
+        response = SESSION.post(
+            f"{MOCK_ENGINE_URL}/admin/speeds",
+            json={"prefill": prefill_speed, "decode": decode_speed},
+            timeout=5
+        )
+        response.raise_for_status()
+    except requests.RequestException as e:
+        print(f"❌ Error: could not update mock-engine speeds ({e})")
         sys.exit(1)
     
-    content = mock_engine_path.read_text()
+    print(f"✅ Updated speeds: PREFILL={prefill_speed}, DECODE={decode_speed}")
+
+def start_mock_server():
+    """Start mock_engine.py in the background"""
+    print("🚀 Starting mock-engine...")
+    process = subprocess.Popen(
+        [sys.executable, 'mock_engine.py'],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    # Make sure Ctrl-C or an early exit never leaks the server
+    atexit.register(stop_mock_server, process)
+    return process
+
+def stop_mock_server(process):
+    """Stop the mock-engine process if it is still running"""
+    if process.poll() is None:
+        print("🛑 Stopping mock-engine...")
+        process.terminate()
+        process.wait()
+
+def wait_for_ready(process, timeout=10):
+    """Poll the mock-engine port until it accepts connections"""
+    deadline = time.monotonic() + timeout
     
-    # Replace the speed values
-    lines = content.split('\n')
-    for i, line in enumerate(lines):
-        if 'PREFILL_TOKENS_PER_SEC' in line and '=' in line:
-            lines[i] = f"PREFILL_TOKENS_PER_SEC = {prefill_speed}  # Simulated prefill speed"
-        elif 'DECODE_TOKENS_PER_SEC' in line and '=' in line:
-            lines[i] = f"DECODE_TOKENS_PER_SEC = {decode_speed}     # Simulated decode speed"
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            with socket.create_connection((MOCK_ENGINE_HOST, MOCK_ENGINE_PORT), timeout=0.05):
+                return True
+        except OSError:
+            time.sleep(0.05)
     
-    mock_engine_path.write_text('\n'.join(lines))
-    print(f"✅ Updated speeds: PREFILL={prefill_speed}, DECODE={decode_speed}")
+    return False
 
 def run_grep_query(query):
-    """Run a single grep query and measure time"""
-    start_time = time.time()
+    """Send a single grep query straight to mock-engine and measure time"""
+    start_ns = time.perf_counter_ns()
     
     try:
-        result = subprocess.run(
-            ['qwen', '-p', query],
-            capture_output=True,
-            text=True,
+        response = SESSION.post(
+            f"{MOCK_ENGINE_URL}/v1/chat/completions",
+            json={
+                "model": "qwen-coder",
+                "messages": [{"role": "user", "content": query}]
+            },
             timeout=30
         )
         
-        end_time = time.time()
-        elapsed = end_time - start_time
+        elapsed = (time.perf_counter_ns() - start_ns) / 1e9
         
-        success = result.returncode == 0
-        
-        return {
-            "success": success,
+        result = {
+            "success": response.ok,
             "time": elapsed,
             "query": query
         }
-    except subprocess.TimeoutExpired:
+        if not response.ok:
+            # The engine itself answered with an error: the only failure
+            # deterministic enough to cache (see run_benchmark_suite)
+            result["error"] = f"HTTP {response.status_code}"
+            result["status"] = response.status_code
+        return result
+    except requests.Timeout:
         return {
             "success": False,
             "time": 30.0,
@@ -88,59 +161,287 @@ def run_grep_query(query):
             "error": str(e)
         }
 
-def run_benchmark_suite(config_name, num_queries=10):
+async def run_grep_query_cli(query, semaphore, debug=False):
+    """Run a single grep query through the qwen CLI and measure time"""
+    # Only the exit code matters for timing, so output is discarded unless debugging
+    output = asyncio.subprocess.PIPE if debug else asyncio.subprocess.DEVNULL
+    
+    async with semaphore:
+        start_ns = time.perf_counter_ns()
+        
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                QWEN, '-p', query,
+                stdout=output,
+                stderr=output
+            )
+            _, stderr = await asyncio.wait_for(proc.communicate(), timeout=30)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return {
+                "success": False,
+                "time": 30.0,
+                "query": query,
+                "error": "timeout"
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "time": 0,
+                "query": query,
+                "error": str(e)
+            }
+        
+        elapsed = (time.perf_counter_ns() - start_ns) / 1e9
+        
+        result = {
+            "success": proc.returncode == 0,
+            "time": elapsed,
+            "query": query
+        }
+        if stderr and proc.returncode != 0:
+            result["error"] = stderr.decode(errors="replace").strip()[-200:]
+        return result
+
+async def run_cli_queries(queries, max_concurrency, debug=False):
+    """Run qwen CLI queries concurrently on the event loop, bounded by a semaphore"""
+    semaphore = asyncio.Semaphore(max_concurrency)
+    return await asyncio.gather(*(run_grep_query_cli(q, semaphore, debug) for q in queries))
+
+def run_grep_batch(queries):
+    """Run all queries through one qwen process; None if batching isn't supported"""
+    start_ns = time.perf_counter_ns()
+    
+    try:
+        result = subprocess.run(
+            [QWEN, '-p', '-'],
+            input=BATCH_DELIMITER.join(queries),
+            capture_output=True,
+            text=True,
+            timeout=30 * len(queries)
+        )
+    except (subprocess.TimeoutExpired, OSError):
+        return None
+    
+    elapsed = (time.perf_counter_ns() - start_ns) / 1e9
+    
+    if result.returncode != 0:
+        return None
+    
+    outputs = result.stdout.split(BATCH_DELIMITER)
+    # A wrong reply count means the stdin contract doesn't hold, so the batch
+    # time isn't measuring these queries; stop rather than report it
+    if len(outputs) != len(queries):
+        raise RuntimeError(
+            f"qwen batch returned {len(outputs)} replies for {len(queries)} queries; "
+            f"its output doesn't follow the {BATCH_DELIMITER!r} contract, so the batch time can't be trusted"
+        )
+    
+    # A single process hides per-query client latency, so only the batch
+    # total is real; per-query times are left unset rather than invented
+    return [
+        {"success": True, "time": None, "query": query, "batched": True, "batch_time": elapsed}
+        for query in queries
+    ]
+
+def cache_prefix(config_name, mode):
+    """Cache key prefix tied to the current mock_engine.py source, config and query mode"""
+    source_hash = hashlib.sha256(Path("mock_engine.py").read_bytes()).hexdigest()[:16]
+    return f"{source_hash}:{mode}:{config_name}:"
+
+def run_benchmark_suite(config_name, num_queries=10, sequential=False, cache=None, via_cli=False, batch=False, debug=False):
     """Run all grep queries and collect timing data"""
+    queries = GREP_QUERIES[:num_queries]
+    mode = "sequentially" if sequential else "in parallel"
+    
     print(f"\n{'='*60}")
-    print(f"Running {num_queries} queries with {config_name} config...")
+    print(f"Running {num_queries} queries {mode} with {config_name} config...")
     print(f"{'='*60}")
     
+    # Only outcomes are cached, never timings: queries the engine already
+    # rejected for this source, mode and config are skipped, everything else
+    # is re-measured
+    known_failures = {}
+    if cache is not None:
+        mode_key = "batch" if batch else "cli" if via_cli else "http"
+        prefix = cache_prefix(config_name, mode_key)
+        for query in queries:
+            outcome = cache.get(prefix + query)
+            if outcome and not outcome["success"]:
+                known_failures[query] = outcome
+    
+    to_run = [q for q in queries if q not in known_failures]
+    
+    # Each query is independent and blocked on I/O, so run them
+    # concurrently; --sequential keeps one-at-a-time per-query latency.
+    max_workers = 1 if sequential else min(len(to_run), os.cpu_count() or 1)
+    
     results = []
     
-    for i, query in enumerate(GREP_QUERIES[:num_queries], 1):
-        print(f"  [{i}/{num_queries}] Running: '{query}'...", end=" ", flush=True)
+    if to_run:
+        fresh_results = run_grep_batch(to_run) if batch else None
+        if batch and fresh_results is None:
+            print("  ⚠️  qwen batch mode not supported, falling back to one process per query")
         
-        result = run_grep_query(query)
-        results.append(result)
+        if fresh_results is None and via_cli:
+            fresh_results = asyncio.run(run_cli_queries(to_run, max_workers, debug))
         
-        if result["success"]:
-            print(f"✅ {result['time']:.3f}s")
-        else:
-            print(f"❌ Failed ({result.get('error', 'unknown')})")
+        if fresh_results is None:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                fresh_results = list(executor.map(run_grep_query, to_run))
         
-        # Small delay between requests
-        time.sleep(0.1)
+        for i, result in enumerate(fresh_results, 1):
+            results.append(result)
+            
+            print(f"  [{i}/{num_queries}] '{result['query']}'...", end=" ")
+            if result.get("batched"):
+                print("✅ (batched)")
+            elif result["success"]:
+                print(f"✅ {result['time']:.3f}s")
+            else:
+                print(f"❌ Failed ({result.get('error', 'unknown')})")
+    
+    for query, outcome in known_failures.items():
+        print(f"  [-/{num_queries}] '{query}'... ⏭️  Skipped (cached {outcome['error'] or 'failure'})")
+        results.append({
+            "success": False,
+            "time": 0,
+            "query": query,
+            "error": outcome["error"],
+            "cached": True
+        })
+    
+    if cache is not None:
+        for result in results:
+            if result.get("cached"):
+                continue
+            # Timeouts, connection errors and CLI failures (missing or broken
+            # qwen) may not happen next time, so only an HTTP error returned
+            # by the engine is remembered; a success clears any old entry
+            if result["success"]:
+                cache.pop(prefix + result["query"], None)
+            elif "status" in result:
+                cache[prefix + result["query"]] = {
+                    "success": False,
+                    "error": result["error"]
+                }
     
     return results
 
 def calculate_stats(results):
     """Calculate benchmark statistics"""
-    times = [r["time"] for r in results if r["success"]]
+    batched = [r for r in results if r.get("batched")]
+    if batched:
+        # One qwen process has no per-query timings, so there are no
+        # percentiles or samples; server percentiles still come from /metrics
+        total = batched[0]["batch_time"]
+        return {
+            "avg": total / len(batched),
+            "total": total,
+            "success_rate": (len(batched) / len(results)) * 100,
+            "batched": True,
+            "queries": len(batched)
+        }
+    
+    times = np.fromiter((r["time"] for r in results if r["success"]), dtype=np.float64)
     
-    if not times:
+    if times.size == 0:
         return {
             "avg": 0,
             "min": 0,
             "max": 0,
             "total": 0,
-            "success_rate": 0
+            "p50": 0,
+            "p90": 0,
+            "p99": 0,
+            "success_rate": 0,
+            "samples": []
         }
     
+    p50, p90, p99 = np.percentile(times, [50, 90, 99])
+    
+    return {
+        "avg": float(times.mean()),
+        "min": float(times.min()),
+        "max": float(times.max()),
+        "total": float(times.sum()),
+        "p50": float(p50),
+        "p90": float(p90),
+        "p99": float(p99),
+        "success_rate": (times.size / len(results)) * 100,
+        # Keep every raw sample so multimodal latency isn't hidden by the mean
+        "samples": times.tolist()
+    }
+
+def scrape_latency_histogram():
+    """Fetch mock-engine's cumulative latency buckets as {upper_bound: count}"""
+    try:
+        response = SESSION.get(f"{MOCK_ENGINE_URL}/metrics", timeout=5)
+        response.raise_for_status()
+    except requests.RequestException:
+        return None
+    
+    buckets = {}
+    for family in text_string_to_metric_families(response.text):
+        if family.name == "mock_resp_seconds":
+            for sample in family.samples:
+                if sample.name == "mock_resp_seconds_bucket":
+                    buckets[float(sample.labels["le"])] = sample.value
+    return buckets
+
+def histogram_quantile(q, buckets):
+    """Estimate a quantile from cumulative buckets, interpolating like Prometheus"""
+    bounds = sorted(buckets)
+    rank = q * buckets[bounds[-1]]
+    prev_bound, prev_count = 0.0, 0.0
+    
+    for bound in bounds:
+        count = buckets[bound]
+        if count >= rank:
+            if math.isinf(bound):
+                return prev_bound
+            return prev_bound + (bound - prev_bound) * (rank - prev_count) / (count - prev_count)
+        prev_bound, prev_count = bound, count
+    
+    return prev_bound
+
+def calculate_server_stats(before, after):
+    """Server-side latency percentiles for the requests made between two scrapes"""
+    if not before or not after:
+        return None
+    
+    # The histogram is cumulative over the server's lifetime, so diff the scrapes
+    buckets = {bound: after[bound] - before.get(bound, 0) for bound in after}
+    count = buckets[max(buckets)]
+    if count == 0:
+        return None
+    
     return {
-        "avg": sum(times) / len(times),
-        "min": min(times),
-        "max": max(times),
-        "total": sum(times),
-        "success_rate": (len(times) / len(results)) * 100
+        "count": int(count),
+        "p50": histogram_quantile(0.50, buckets),
+        "p90": histogram_quantile(0.90, buckets),
+        "p99": histogram_quantile(0.99, buckets)
     }
 
 def print_results(config_name, stats):
     """Print formatted benchmark results"""
     print(f"\n📊 Results for {config_name}:")
-    print(f"  Average time:  {stats['avg']:.3f}s")
-    print(f"  Min time:      {stats['min']:.3f}s")
-    print(f"  Max time:      {stats['max']:.3f}s")
-    print(f"  Total time:    {stats['total']:.3f}s")
+    if stats.get("batched"):
+        print(f"  Batch time:    {stats['total']:.3f}s ({stats['queries']} queries in one qwen process)")
+        print(f"  Mean / query:  {stats['avg']:.3f}s")
+    else:
+        print(f"  Average time:  {stats['avg']:.3f}s")
+        print(f"  Min time:      {stats['min']:.3f}s")
+        print(f"  Max time:      {stats['max']:.3f}s")
+        print(f"  p50/p90/p99:   {stats['p50']:.3f}s / {stats['p90']:.3f}s / {stats['p99']:.3f}s")
+        print(f"  Total time:    {stats['total']:.3f}s")
     print(f"  Success rate:  {stats['success_rate']:.1f}%")
+    
+    server = stats.get("server")
+    if server:
+        print(f"  Server p50/p90/p99: {server['p50']:.3f}s / {server['p90']:.3f}s / {server['p99']:.3f}s "
+              f"({server['count']} requests)")
 
 def print_comparison(all_results):
     """Print comparison table of all configurations"""
@@ -154,24 +455,74 @@ def print_comparison(all_results):
         print(f"{config_name:<15} {config['prefill']:<10} {config['decode']:<10} "
               f"{stats['avg']:.3f}s{' '*6} {stats['total']:.3f}s")
     
+    # Configs without a single successful query have no timing to rank
+    ranked = [r for r in all_results if r[2]['avg'] > 0]
+    if not ranked:
+        print("\n⚠️  No configuration completed a query; nothing to compare")
+        return
+    
     # Find fastest
-    fastest = min(all_results, key=lambda x: x[2]['avg'])
+    fastest = min(ranked, key=lambda x: x[2]['avg'])
     print(f"\n🏆 Fastest config: {fastest[0]} (avg: {fastest[2]['avg']:.3f}s)")
     
     # Calculate speedup
-    slowest = max(all_results, key=lambda x: x[2]['avg'])
+    slowest = max(ranked, key=lambda x: x[2]['avg'])
     speedup = slowest[2]['avg'] / fastest[2]['avg']
     print(f"⚡ Speedup: {speedup:.2f}x faster than slowest")
 
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="Benchmark Mock Engine")
+    parser.add_argument(
+        "--sequential",
+        action="store_true",
+        help="run queries one at a time to measure per-query latency"
+    )
+    parser.add_argument(
+        "--via-cli",
+        action="store_true",
+        help="send queries through the qwen CLI instead of direct HTTP"
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="send all queries through a single qwen process on stdin (implies --via-cli); "
+             "reports only the batch total and per-query mean, and aborts if the replies don't match the queries"
+    )
+    parser.add_argument(
+        "--cooldown",
+        type=float,
+        default=0,
+        help="seconds to pause between configs (default: 0)"
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="capture qwen output and report stderr for failed queries"
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help=f"skip queries the engine already rejected for the same engine, mode and config (stored in {CACHE_FILE})"
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="clear the outcome cache before running (implies --cache)"
+    )
+    return parser.parse_args()
+
 def main():
     """Main benchmark runner"""
+    args = parse_args()
+    if args.batch:
+        args.via_cli = True
+    
     print("🚀 Mock Engine Benchmark Tool")
     print("=" * 60)
     
     # Check if qwen is available
-    try:
-        subprocess.run(['qwen', '--version'], capture_output=True, check=True)
-    except (subprocess.CalledProcessError, FileNotFoundError):
+    if args.via_cli and QWEN is None:
         print("❌ Error: 'qwen' command not found. Please install qwen-code.")
         sys.exit(1)
     
@@ -181,62 +532,79 @@ def main():
         sys.exit(1)
     
     print("✅ Environment check passed")
-    print("\n⚠️  Make sure mock-engine is NOT running before starting!")
-    print("    This script will need to restart it with different configs.")
     
-    input("\nPress Enter to continue...")
+    # One mock-engine serves every config; speeds are switched over HTTP
+    server_process = start_mock_server()
+    if not wait_for_ready(server_process):
+        stop_mock_server(server_process)
+        print("❌ Error: mock-engine did not start (is port 8000 already in use?)")
+        sys.exit(1)
     
     all_results = []
+    cache = shelve.open(CACHE_FILE) if args.cache or args.refresh else None
+    # Partial runs keep every config that finished, even after Ctrl-C
+    stream = open(STREAM_FILE, 'wb')
     
-    # Run benchmarks for each configuration
-    for config in TOKEN_CONFIGS:
-        print(f"\n{'='*60}")
-        print(f"🔧 Testing configuration: {config['name']}")
-        print(f"{'='*60}")
-        
-        # Update mock_engine.py with new speeds
-        update_mock_engine_speeds(config['prefill'], config['decode'])
-        
-        print("\n⏳ Please restart mock-engine manually:")
-        print("   1. Stop the current mock-engine (Ctrl+C)")
-        print("   2. Run: python3 mock_engine.py")
-        print("   3. Wait for 'Running on http://127.0.0.1:8000'")
-        
-        input("\nPress Enter when mock-engine is ready...")
-        
-        # Run benchmark suite
-        results = run_benchmark_suite(config['name'])
-        
-        # Calculate statistics
-        stats = calculate_stats(results)
-        
-        # Print results
-        print_results(config['name'], stats)
-        
-        # Store for comparison
-        all_results.append((config['name'], config, stats))
+    # The cache and stream are closed (and the dbm flushed) however the run ends
+    try:
+        if args.refresh:
+            cache.clear()
         
-        # Small break between configs
-        time.sleep(1)
+        # Run benchmarks for each configuration
+        for config in TOKEN_CONFIGS:
+            print(f"\n{'='*60}")
+            print(f"🔧 Testing configuration: {config['name']}")
+            print(f"{'='*60}")
+            
+            set_mock_engine_speeds(config['prefill'], config['decode'])
+            
+            # Run benchmark suite
+            histogram_before = scrape_latency_histogram()
+            results = run_benchmark_suite(
+                config['name'], sequential=args.sequential, cache=cache,
+                via_cli=args.via_cli, batch=args.batch, debug=args.debug
+            )
+            
+            # Calculate statistics
+            stats = calculate_stats(results)
+            stats["server"] = calculate_server_stats(histogram_before, scrape_latency_histogram())
+            
+            # Print results
+            print_results(config['name'], stats)
+            
+            # Store for comparison
+            all_results.append((config['name'], config, stats))
+            stream.write(orjson.dumps({"name": config['name'], "config": config, "stats": stats}) + b"\n")
+            stream.flush()
+            
+            # Optional pause between configs (--cooldown)
+            if args.cooldown:
+                time.sleep(args.cooldown)
+    except RuntimeError as e:
+        print(f"\n❌ Error: {e}")
+        sys.exit(1)
+    finally:
+        stop_mock_server(server_process)
+        stream.close()
+        if cache is not None:
+            cache.close()
     
     # Print final comparison
     print_comparison(all_results)
     
     # Save results to JSON
-    output_file = "benchmark_results.json"
-    with open(output_file, 'w') as f:
-        json.dump({
-            "configs": [
-                {
-                    "name": name,
-                    "config": config,
-                    "stats": stats
-                }
-                for name, config, stats in all_results
-            ]
-        }, f, indent=2)
+    Path(OUTPUT_FILE).write_bytes(orjson.dumps({
+        "configs": [
+            {
+                "name": name,
+                "config": config,
+                "stats": stats
+            }
+            for name, config, stats in all_results
+        ]
+    }, option=orjson.OPT_INDENT_2))
     
-    print(f"\n💾 Results saved to: {output_file}")
+    print(f"\n💾 Results saved to: {OUTPUT_FILE} (per-config lines in {STREAM_FILE})")
     print("\n✨ Benchmark complete!")
 
 if __name__ == '__main__':
@@ -50,6 +50,9 @@ declare -a QUERIES=(
     "search for API endpoints"
 )
 
+# Optional pause between configs in seconds (e.g. COOLDOWN=2 ./benchmark_auto.sh)
+COOLDOWN=${COOLDOWN:-0}
+
 # Results file
 RESULTS_FILE="benchmark_results.txt"
 echo "Mock Engine Benchmark Results" > $RESULTS_FILE
@@ -70,7 +73,7 @@ update_speeds() {
 # Function to start mock-engine
 start_mock_engine() {
     echo "🔄 Starting mock-engine..."
-    python3 mock_engine.py > /dev/null 2>&1 &
+    ./serve_mock_engine.sh > /dev/null 2>&1 &
     MOCK_PID=$!
     
     # Wait for server to be ready
@@ -147,8 +150,6 @@ run_benchmark() {
         else
             echo -e "${RED}❌ Failed${NC}"
         fi
-        
-        sleep 0.2
     done
     
     # Calculate statistics
@@ -201,7 +202,7 @@ echo ""
 for config in "${CONFIGS[@]}"; do
     IFS=':' read -r prefill decode name <<< "$config"
     run_benchmark "$name" "$prefill" "$decode"
-    sleep 2
+    sleep "$COOLDOWN"
 done
 
 # Print summary
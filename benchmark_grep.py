@@ -3,12 +3,24 @@ Benchmark Script for Testing qwen-code-ipc with Mock vLLM
 Runs 10 grep operations back-to-back and measures performance
 """
 
+import argparse
+import os
+import re
+import shutil
+import socket
 import subprocess
+import sys
+import tempfile
 import time
 import json
 import statistics
-from typing import List, Dict
+from typing import List, Dict, Callable
 from datetime import datetime
+from functools import lru_cache, partial
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
 
 # ============================================================================
 # CONFIGURATION
@@ -31,39 +43,88 @@ GREP_QUERIES = [
     "search for 'await' keywords"
 ]
 
+MOCK_ENGINE_PATH = Path('mock_engine.py')
+
+# Decode speed assignment in mock_engine.py
+_DECODE_PAT = re.compile(r'DECODE_TOKENS_PER_SEC\s*=\s*\d+')
+
+# Mock server chat endpoint
+CHAT_COMPLETIONS_URL = 'http://localhost:8000/v1/chat/completions'
+
+# Absolute path of the qwen-code CLI, resolved once instead of on every exec
+QWEN_CODE = shutil.which('qwen-code')
+
+# One pooled session so every query reuses the same TCP connection
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=16))
+
 # ============================================================================
 # HELPER FUNCTIONS
 # ============================================================================
 
+@lru_cache(maxsize=1)
+def original_mock_engine_source() -> str:
+    """mock_engine.py as it was before the first speed change"""
+    return MOCK_ENGINE_PATH.read_text()
+
+def write_mock_engine(content: str):
+    """Atomically replace mock_engine.py so an interrupt never leaves it half-written"""
+    tmp_path = MOCK_ENGINE_PATH.with_suffix('.py.tmp')
+    tmp_path.write_text(content)
+    os.replace(tmp_path, MOCK_ENGINE_PATH)
+
 def update_mock_engine_speed(tokens_per_sec: int):
     """Update the DECODE_TOKENS_PER_SEC in mock_engine.py"""
-    with open('mock_engine.py', 'r') as f:
-        content = f.read()
-    
-    # Replace the speed setting
-    import re
-    content = re.sub(
-        r'DECODE_TOKENS_PER_SEC = \d+',
+    # Always derive from the cached original instead of re-reading the file
+    content = _DECODE_PAT.sub(
         f'DECODE_TOKENS_PER_SEC = {tokens_per_sec}',
-        content
+        original_mock_engine_source()
     )
-    
-    with open('mock_engine.py', 'w') as f:
-        f.write(content)
+    write_mock_engine(content)
     
     print(f"✅ Updated mock_engine.py: DECODE_TOKENS_PER_SEC = {tokens_per_sec}")
 
+def restore_mock_engine():
+    """Put back the original mock_engine.py if any speed was changed"""
+    if original_mock_engine_source.cache_info().currsize:
+        write_mock_engine(original_mock_engine_source())
+        print("✅ Restored original mock_engine.py")
+
 def start_mock_server():
     """Start the mock vLLM server in background"""
     print("🚀 Starting mock vLLM server...")
+    # Nothing reads the server output; an unread pipe would eventually block it
     process = subprocess.Popen(
         ['python', 'mock_engine.py'],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
     )
-    time.sleep(2)  # Wait for server to start
+    if not wait_for_ready(process):
+        # Reap the half-started server so it can't keep holding port 8000
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        raise RuntimeError("mock-engine did not start (is port 8000 already in use?)")
     return process
 
+def wait_for_ready(process, timeout=10):
+    """Poll the mock server port until it accepts connections"""
+    deadline = time.monotonic() + timeout
+    
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            with socket.create_connection(('127.0.0.1', 8000), timeout=0.05):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    
+    return False
+
 def stop_mock_server(process):
     """Stop the mock vLLM server"""
     print("🛑 Stopping mock vLLM server...")
@@ -71,31 +132,80 @@ def stop_mock_server(process):
     process.wait()
 
 def run_grep_query(query: str) -> Dict:
-    """Run a single grep query using qwen-code CLI and measure timing"""
-    start_time = time.time()
+    """Send a single grep query straight to the mock server and measure timing"""
+    start_ns = time.perf_counter_ns()
     
     try:
-        result = subprocess.run(
-            ['qwen-code', 'query', query],
-            capture_output=True,
-            text=True,
-            timeout=30,
-            env={
-                'OPENAI_BASE_URL': 'http://localhost:8000/v1',
-                'OPENAI_API_KEY': 'mock-key'
-            }
+        response = SESSION.post(
+            CHAT_COMPLETIONS_URL,
+            json={
+                'model': 'qwen-coder',
+                'messages': [{'role': 'user', 'content': query}]
+            },
+            timeout=30
         )
         
-        elapsed_time = time.time() - start_time
+        elapsed_time = (time.perf_counter_ns() - start_ns) / 1e9
         
         return {
+            'success': response.ok,
+            'elapsed_time': elapsed_time,
+            'output_length': len(response.content),
+            'query': query
+        }
+    except requests.Timeout:
+        elapsed_time = (time.perf_counter_ns() - start_ns) / 1e9
+        return {
+            'success': False,
+            'elapsed_time': elapsed_time,
+            'output_length': 0,
+            'query': query,
+            'error': 'timeout'
+        }
+    except Exception as e:
+        elapsed_time = (time.perf_counter_ns() - start_ns) / 1e9
+        return {
+            'success': False,
+            'elapsed_time': elapsed_time,
+            'output_length': 0,
+            'query': query,
+            'error': str(e)
+        }
+
+def run_grep_query_cli(query: str, debug: bool = False) -> Dict:
+    """Run a single grep query using qwen-code CLI and measure timing"""
+    start_ns = time.perf_counter_ns()
+    
+    try:
+        # stdout goes to a temp file so its length is known without copying
+        # it into Python; stderr is only kept when debugging
+        with tempfile.TemporaryFile() as stdout_file:
+            result = subprocess.run(
+                [QWEN_CODE, 'query', query],
+                stdout=stdout_file,
+                stderr=subprocess.PIPE if debug else subprocess.DEVNULL,
+                text=True,
+                timeout=30,
+                env={
+                    'OPENAI_BASE_URL': 'http://localhost:8000/v1',
+                    'OPENAI_API_KEY': 'mock-key'
+                }
+            )
+            
+            elapsed_time = (time.perf_counter_ns() - start_ns) / 1e9
+            output_length = os.fstat(stdout_file.fileno()).st_size
+        
+        stats = {
             'success': result.returncode == 0,
             'elapsed_time': elapsed_time,
-            'output_length': len(result.stdout),
+            'output_length': output_length,
             'query': query
         }
+        if result.stderr and result.returncode != 0:
+            stats['error'] = result.stderr.strip()[-200:]
+        return stats
     except subprocess.TimeoutExpired:
-        elapsed_time = time.time() - start_time
+        elapsed_time = (time.perf_counter_ns() - start_ns) / 1e9
         return {
             'success': False,
             'elapsed_time': elapsed_time,
@@ -104,7 +214,7 @@ def run_grep_query(query: str) -> Dict:
             'error': 'timeout'
         }
     except Exception as e:
-        elapsed_time = time.time() - start_time
+        elapsed_time = (time.perf_counter_ns() - start_ns) / 1e9
         return {
             'success': False,
             'elapsed_time': elapsed_time,
@@ -113,7 +223,7 @@ def run_grep_query(query: str) -> Dict:
             'error': str(e)
         }
 
-def run_benchmark_suite(tokens_per_sec: int) -> Dict:
+def run_benchmark_suite(tokens_per_sec: int, run_query: Callable[[str], Dict] = run_grep_query) -> Dict:
     """Run all 10 grep queries and collect statistics"""
     print(f"\n{'='*70}")
     print(f"📊 BENCHMARK: {tokens_per_sec} tokens/sec")
@@ -123,7 +233,7 @@ def run_benchmark_suite(tokens_per_sec: int) -> Dict:
     
     for i, query in enumerate(GREP_QUERIES, 1):
         print(f"\n[{i}/10] Running: {query[:50]}...")
-        result = run_grep_query(query)
+        result = run_query(query)
         results.append(result)
         
         status = "✅" if result['success'] else "❌"
@@ -207,7 +317,35 @@ def save_results(all_results: List[Dict], filename: str = None):
 # MAIN BENCHMARK
 # ============================================================================
 
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="Benchmark qwen-code-ipc against the mock vLLM server")
+    parser.add_argument(
+        '--via-cli',
+        action='store_true',
+        help='send queries through the qwen-code CLI instead of direct HTTP'
+    )
+    parser.add_argument(
+        '--cooldown',
+        type=float,
+        default=0,
+        help='seconds to pause between test suites (default: 0)'
+    )
+    parser.add_argument(
+        '--debug',
+        action='store_true',
+        help='capture qwen-code stderr and report it for failed queries'
+    )
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+    run_query = partial(run_grep_query_cli, debug=args.debug) if args.via_cli else run_grep_query
+    
+    if args.via_cli and QWEN_CODE is None:
+        print("❌ Error: 'qwen-code' command not found")
+        sys.exit(1)
+    
     print("="*70)
     print("🚀 qwen-code-ipc Mock vLLM Benchmark")
     print("="*70)
@@ -228,14 +366,16 @@ def main():
             # Restart server with new speed
             if server_process:
                 stop_mock_server(server_process)
+                server_process = None
             server_process = start_mock_server()
             
             # Run benchmark suite
-            results = run_benchmark_suite(speed)
+            results = run_benchmark_suite(speed, run_query)
             all_results.append(results)
             
-            # Small delay between test suites
-            time.sleep(1)
+            # Optional pause between test suites (--cooldown)
+            if args.cooldown:
+                time.sleep(args.cooldown)
         
         # Print summary
         print_summary(all_results)
@@ -250,6 +390,7 @@ def main():
     finally:
         if server_process:
             stop_mock_server(server_process)
+        restore_mock_engine()
     
     print("\n✨ Benchmark complete!\n")
 
@@ -3,15 +3,23 @@
 Benchmark with log parsing - Shows both qwen time AND mock-engine API time
 """
 
+import argparse
+import atexit
+import shutil
+import socket
 import subprocess
 import time
 import json
 import sys
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from threading import Thread
-from queue import Queue
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
 
 # Set environment variables
 os.environ['OPENAI_BASE_URL'] = 'http://localhost:8000/v1'
@@ -30,90 +38,173 @@ CONFIGS = [
     {"prefill": 10000000, "decode": 10000000, "name": "Instant"},
 ]
 
-# Store mock-engine log output
-log_queue = Queue()
+# Where mock_engine.py listens and writes its log
+MOCK_ENGINE_HOST = "127.0.0.1"
+MOCK_ENGINE_PORT = 8000
+MOCK_ENGINE_URL = f"http://{MOCK_ENGINE_HOST}:{MOCK_ENGINE_PORT}"
+LOG_FILE = "mock_engine.log"
 
-def tail_mock_engine_logs(log_file="mock_engine.log"):
-    """Tail mock-engine logs in background"""
-    try:
-        with open(log_file, 'r') as f:
-            # Go to end
-            f.seek(0, 2)
-            
-            while True:
-                line = f.readline()
-                if line:
-                    log_queue.put(line.strip())
-                time.sleep(0.01)
-    except:
-        pass
+# Absolute path of the qwen CLI, resolved once instead of on every exec
+QWEN = shutil.which('qwen')
 
-def extract_api_time_from_logs():
-    """Extract the last API response time from logs"""
-    lines = []
-    
-    # Drain queue
-    while not log_queue.empty():
-        lines.append(log_queue.get())
-    
-    # Find last "Response sent in X.XXXs"
-    for line in reversed(lines):
-        match = re.search(r'Response sent in ([\d.]+)s', line)
+# One pooled session so every query reuses the same TCP connection
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=16))
+
+# Server-side time line logged by mock_engine.py, used for the CLI path
+# (bytes, since the log is read in binary mode)
+_TIME_RE = re.compile(rb'Total API time: ([\d.]+)s')
+
+def read_api_time_from_log(log_fh, attempts=50):
+    """Read lines logged since log_fh was positioned until the API time appears"""
+    for _ in range(attempts):
+        line = log_fh.readline()
+        if not line:
+            # Bounded wait in case the line lands just after qwen exits
+            time.sleep(0.01)
+            continue
+        match = _TIME_RE.search(line)
         if match:
             return float(match.group(1))
     
     return None
 
-def update_mock_engine_speeds(prefill_speed, decode_speed):
-    """Update token speeds in mock_engine.py"""
-    mock_engine_path = Path("mock_engine.py")
-    
-    if not mock_engine_path.exists():
-        print("❌ Error: mock_engine.py not found")
+def set_mock_engine_speeds(prefill_speed, decode_speed):
+    """Switch the running mock-engine to new token speeds"""
+    try:
+        response = SESSION.post(
+            f"{MOCK_ENGINE_URL}/admin/speeds",
+            json={"prefill": prefill_speed, "decode": decode_speed},
+            timeout=5
+        )
+        response.raise_for_status()
+    except requests.RequestException as e:
+        print(f"❌ Error: could not update mock-engine speeds ({e})")
         sys.exit(1)
     
-    content = mock_engine_path.read_text()
-    lines = content.split('\n')
+    print(f"✅ Updated: PREFILL={prefill_speed}, DECODE={decode_speed}")
+
+def start_mock_server():
+    """Start mock_engine.py in the background, appending its output to the log"""
+    print("🚀 Starting mock-engine...")
+    with open(LOG_FILE, 'a') as log:
+        # -u so log lines reach the file as soon as they are printed, and
+        # INFO so the engine logs the per-request API time parsed below
+        process = subprocess.Popen(
+            [sys.executable, '-u', 'mock_engine.py'],
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            env={**os.environ, 'MOCK_ENGINE_LOG_LEVEL': 'INFO'}
+        )
+    # Make sure Ctrl-C or an early exit never leaks the server
+    atexit.register(stop_mock_server, process)
+    return process
+
+def stop_mock_server(process):
+    """Stop the mock-engine process if it is still running"""
+    if process.poll() is None:
+        print("🛑 Stopping mock-engine...")
+        process.terminate()
+        process.wait()
+
+def wait_for_ready(process, timeout=10):
+    """Poll the mock-engine port until it accepts connections"""
+    deadline = time.monotonic() + timeout
     
-    for i, line in enumerate(lines):
-        if 'PREFILL_TOKENS_PER_SEC' in line and '=' in line:
-            lines[i] = f"PREFILL_TOKENS_PER_SEC = {prefill_speed}  # Simulated prefill speed"
-        elif 'DECODE_TOKENS_PER_SEC' in line and '=' in line:
-            lines[i] = f"DECODE_TOKENS_PER_SEC = {decode_speed}     # Simulated decode speed"
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            with socket.create_connection((MOCK_ENGINE_HOST, MOCK_ENGINE_PORT), timeout=0.05):
+                return True
+        except OSError:
+            time.sleep(0.05)
     
-    mock_engine_path.write_text('\n'.join(lines))
-    print(f"✅ Updated: PREFILL={prefill_speed}, DECODE={decode_speed}")
+    return False
+
+def run_http_query(query):
+    """Send query straight to mock-engine and measure client round-trip time"""
+    start_ns = time.perf_counter_ns()
+    
+    try:
+        response = SESSION.post(
+            f"{MOCK_ENGINE_URL}/v1/chat/completions",
+            json={
+                "model": "qwen-coder",
+                "messages": [{"role": "user", "content": query}]
+            },
+            timeout=30
+        )
+        
+        # Stored as "qwen_time" (the client-side time) so both modes share one table
+        qwen_time = (time.perf_counter_ns() - start_ns) / 1e9
+        
+        # Server-measured time comes back on the response itself
+        elapsed_ms = response.headers.get('X-Mock-Elapsed-Ms')
+        api_time = float(elapsed_ms) / 1000 if elapsed_ms else None
+        
+        return {
+            "success": response.ok,
+            "qwen_time": qwen_time,
+            "api_time": api_time,
+            "overhead": qwen_time - api_time if api_time else None,
+            "query": query
+        }
+    except requests.Timeout:
+        return {
+            "success": False,
+            "qwen_time": 30.0,
+            "api_time": None,
+            "overhead": None,
+            "query": query,
+            "error": "timeout"
+        }
+    except Exception as e:
+        return {
+            "success": False,
+            "qwen_time": 0,
+            "api_time": None,
+            "overhead": None,
+            "query": query,
+            "error": str(e)
+        }
 
-def run_qwen_query(query):
+def run_qwen_query(query, debug=False):
     """Run qwen query and measure total time"""
-    start_time = time.time()
+    # Position at the end of the log before the query so only its lines are read
+    log_fh = open(LOG_FILE, 'rb')
+    log_fh.seek(0, os.SEEK_END)
+    # Only the exit code matters for timing, so output is discarded unless debugging
+    output = subprocess.PIPE if debug else subprocess.DEVNULL
+    start_ns = time.perf_counter_ns()
     
     try:
         result = subprocess.run(
-            ['qwen', '-p', query],
-            capture_output=True,
+            [QWEN, '-p', query],
+            stdout=output,
+            stderr=output,
             text=True,
             timeout=30
         )
         
-        end_time = time.time()
-        qwen_time = end_time - start_time
+        qwen_time = (time.perf_counter_ns() - start_ns) / 1e9
         
-        # Give logs a moment to update
-        time.sleep(0.1)
-        
-        # Extract API time from logs
-        api_time = extract_api_time_from_logs()
+        # Extract API time from what the server logged during this query
+        # (mock_engine.py runs unbuffered and logs before it responds)
+        api_time = read_api_time_from_log(log_fh)
         
         success = result.returncode == 0
         
-        return {
+        stats = {
             "success": success,
             "qwen_time": qwen_time,
             "api_time": api_time,
             "overhead": qwen_time - api_time if api_time else None,
             "query": query
         }
+        if result.stderr and not success:
+            stats["error"] = result.stderr.strip()[-200:]
+        return stats
     except subprocess.TimeoutExpired:
         return {
             "success": False,
@@ -132,37 +223,58 @@ def run_qwen_query(query):
             "query": query,
             "error": str(e)
         }
+    finally:
+        log_fh.close()
 
-def run_benchmark(config_name, num_queries=5):
+def run_benchmark(config_name, run_query=run_http_query, num_queries=5, sequential=False, label="HTTP"):
     """Run benchmark suite"""
+    queries = GREP_QUERIES[:num_queries]
+    
     print(f"\n{'='*80}")
     print(f"🔧 Testing: {config_name}")
     print(f"{'='*80}")
-    print(f"{'Query':<45} {'Qwen':<10} {'API':<10} {'Overhead':<10}")
+    print(f"{'Query':<45} {label:<10} {'API':<10} {'Overhead':<10}")
     print(f"{'-'*80}")
     
+    # Queries are independent, so run them concurrently
+    max_workers = 1 if sequential else min(len(queries), os.cpu_count() or 1)
+    
     results = []
     
-    for i, query in enumerate(GREP_QUERIES[:num_queries], 1):
-        result = run_qwen_query(query)
-        results.append(result)
-        
-        if result["success"] and result["api_time"]:
-            print(f"{query[:44]:<45} "
-                  f"{result['qwen_time']:.3f}s{' '*4} "
-                  f"{result['api_time']:.3f}s{' '*4} "
-                  f"{result['overhead']:.3f}s")
-        elif result["success"]:
-            print(f"{query[:44]:<45} "
-                  f"{result['qwen_time']:.3f}s{' '*4} "
-                  f"N/A{' '*7} N/A")
-        else:
-            print(f"{query[:44]:<45} FAILED")
-        
-        time.sleep(0.2)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for result in executor.map(run_query, queries):
+            results.append(result)
+            query = result["query"]
+            
+            if result["success"] and result["api_time"]:
+                print(f"{query[:44]:<45} "
+                      f"{result['qwen_time']:.3f}s{' '*4} "
+                      f"{result['api_time']:.3f}s{' '*4} "
+                      f"{result['overhead']:.3f}s")
+            elif result["success"]:
+                print(f"{query[:44]:<45} "
+                      f"{result['qwen_time']:.3f}s{' '*4} "
+                      f"N/A{' '*7} N/A")
+            else:
+                error = result.get("error")
+                print(f"{query[:44]:<45} FAILED" + (f" ({error})" if error else ""))
     
     return results
 
+def summarize(times):
+    """Summarize raw timing samples, keeping the samples themselves"""
+    arr = np.asarray(times, dtype=np.float64)
+    p50, p90, p99 = np.percentile(arr, [50, 90, 99])
+    
+    return {
+        "avg": float(arr.mean()),
+        "total": float(arr.sum()),
+        "p50": float(p50),
+        "p90": float(p90),
+        "p99": float(p99),
+        "samples": arr.tolist()
+    }
+
 def calculate_stats(results):
     """Calculate statistics"""
     qwen_times = [r["qwen_time"] for r in results if r["success"]]
@@ -172,33 +284,22 @@ def calculate_stats(results):
     if not qwen_times:
         return None
     
-    stats = {
-        "qwen": {
-            "avg": sum(qwen_times) / len(qwen_times),
-            "total": sum(qwen_times)
-        }
-    }
+    stats = {"qwen": summarize(qwen_times)}
     
     if api_times:
-        stats["api"] = {
-            "avg": sum(api_times) / len(api_times),
-            "total": sum(api_times)
-        }
+        stats["api"] = summarize(api_times)
     
     if overhead_times:
-        stats["overhead"] = {
-            "avg": sum(overhead_times) / len(overhead_times),
-            "total": sum(overhead_times)
-        }
+        stats["overhead"] = summarize(overhead_times)
     
     return stats
 
-def print_comparison(all_results):
+def print_comparison(all_results, label="HTTP"):
     """Print comparison"""
     print(f"\n{'='*80}")
     print("📊 BENCHMARK COMPARISON")
     print(f"{'='*80}")
-    print(f"{'Config':<15} {'Qwen Avg':<12} {'API Avg':<12} {'Overhead':<12} {'Speedup':<10}")
+    print(f"{'Config':<15} {label + ' Avg':<12} {'API Avg':<12} {'Overhead':<12} {'Speedup':<10}")
     print(f"{'-'*80}")
     
     for config_name, config, stats in all_results:
@@ -213,6 +314,13 @@ def print_comparison(all_results):
     
     print(f"{'-'*80}")
     
+    # Averages hide multimodal latency, so show the spread as well
+    for config_name, config, stats in all_results:
+        if stats:
+            qwen = stats["qwen"]
+            print(f"{config_name:<15} {label} p50/p90/p99: "
+                  f"{qwen['p50']:.3f}s / {qwen['p90']:.3f}s / {qwen['p99']:.3f}s")
+    
     # Calculate speedup on API time only
     api_results = [(name, cfg, stats) for name, cfg, stats in all_results 
                    if stats and "api" in stats]
@@ -228,58 +336,81 @@ def print_comparison(all_results):
         print(f"   Slowest: {slowest[0]} - {slowest[2]['api']['avg']:.3f}s")
         print(f"   ⚡ API Speedup: {api_speedup:.0f}x faster")
         
-        print(f"\n📈 Qwen Total Time Results:")
+        print(f"\n📈 {label} Total Time Results:")
         print(f"   Fastest: {fastest[0]} - {fastest[2]['qwen']['avg']:.3f}s")
         print(f"   Slowest: {slowest[0]} - {slowest[2]['qwen']['avg']:.3f}s")
         print(f"   ⚡ Total Speedup: {slowest[2]['qwen']['avg'] / fastest[2]['qwen']['avg']:.2f}x faster")
         
-        print(f"\n💡 Overhead: ~{fastest[2]['overhead']['avg']:.2f}s constant qwen CLI overhead")
+        if label == "Qwen CLI":
+            print(f"\n💡 Overhead: ~{fastest[2]['overhead']['avg']:.2f}s constant qwen CLI overhead")
+
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="Benchmark qwen + Mock Engine")
+    parser.add_argument(
+        "--sequential",
+        action="store_true",
+        help="run queries one at a time (always on with --via-cli, so API times map to their query)"
+    )
+    parser.add_argument(
+        "--via-cli",
+        action="store_true",
+        help="send queries through the qwen CLI instead of direct HTTP"
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="capture qwen output instead of discarding it"
+    )
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
+    
     print("🚀 Qwen + Mock-Engine Benchmark")
     print("="*80)
-    print("This measures BOTH qwen total time AND mock-engine API time")
+    label = "Qwen CLI" if args.via_cli else "HTTP"
+    print(f"This measures BOTH {label} total time AND mock-engine API time")
     print("="*80)
     
     # Check qwen
-    try:
-        subprocess.run(['qwen', '--version'], capture_output=True, check=True)
-    except:
+    if args.via_cli and QWEN is None:
         print("❌ Error: 'qwen' not found")
         sys.exit(1)
     
+    run_query = partial(run_qwen_query, debug=args.debug) if args.via_cli else run_http_query
+    # The CLI path reads its API time from the first log line after its own
+    # offset, which is only its own line when queries don't overlap
+    sequential = args.sequential or args.via_cli
+    
     if not Path("mock_engine.py").exists():
         print("❌ Error: mock_engine.py not found")
         sys.exit(1)
     
     print("✅ Environment ready")
-    print("\n⚠️  Make sure mock-engine is running with output redirected:")
-    print("    python3 mock_engine.py 2>&1 | tee mock_engine.log")
-    print("\n   This allows us to capture API timing from logs")
+    print(f"📄 mock-engine output is captured in {LOG_FILE}")
     
-    input("\nPress Enter to continue...")
     
-    # Start log tailer
-    log_thread = Thread(target=tail_mock_engine_logs, daemon=True)
-    log_thread.start()
+    # One mock-engine serves every config; speeds are switched over HTTP
+    server_process = start_mock_server()
+    if not wait_for_ready(server_process):
+        print("❌ Error: mock-engine did not start (is port 8000 already in use?)")
+        sys.exit(1)
     
     all_results = []
     
     for config in CONFIGS:
         print(f"\n📝 Configuring: {config['name']}")
-        update_mock_engine_speeds(config['prefill'], config['decode'])
-        
-        print("\n⏳ Restart mock-engine with log capture:")
-        print("   python3 mock_engine.py 2>&1 | tee mock_engine.log")
+        set_mock_engine_speeds(config['prefill'], config['decode'])
         
-        input("\nPress Enter when ready...")
-        
-        results = run_benchmark(config['name'])
+        results = run_benchmark(config['name'], run_query, sequential=sequential, label=label)
         stats = calculate_stats(results)
         
         all_results.append((config['name'], config, stats))
     
-    print_comparison(all_results)
+    stop_mock_server(server_process)
+    
+    print_comparison(all_results, label)
     
     print(f"\n✨ Benchmark complete!")
 
@@ -1,15 +1,47 @@
 #!/usr/bin/env python3
-from flask import Flask, request, jsonify, Response
+from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, Histogram, generate_latest
+from functools import lru_cache
+import asyncio
+import logging
+import os
 import time
 import json
+import orjson
 import re
+import uvicorn
 
-app = Flask(__name__)
+# Per-request diagnostics go through logging so they cost nothing unless
+# enabled: WARNING by default, INFO adds the per-request API time (parsed by
+# benchmark_with_logs.py), DEBUG adds request details
+logging.basicConfig(
+    level=os.environ.get("MOCK_ENGINE_LOG_LEVEL", "WARNING").upper(),
+    format="%(asctime)s %(message)s",
+    datefmt="%H:%M:%S"
+)
+logger = logging.getLogger("mockengine")
+
+app = FastAPI(title="Mock Engine", default_response_class=ORJSONResponse)
 
 # Configuration - SET TO INSTANT for realistic performance
 PREFILL_TOKENS_PER_SEC = 10000000
 DECODE_TOKENS_PER_SEC = 10000000
 
+# Live speeds used by every request: seeded from the environment (falling back
+# to the values above) and switchable at runtime via POST /admin/speeds
+SPEEDS = {
+    "prefill": int(os.environ.get("PREFILL_TOKENS_PER_SEC", PREFILL_TOKENS_PER_SEC)),
+    "decode": int(os.environ.get("DECODE_TOKENS_PER_SEC", DECODE_TOKENS_PER_SEC)),
+}
+
+# Server-side latency of /v1/chat/completions, scraped from /metrics
+REQUEST_SECONDS = Histogram(
+    'mock_resp_seconds',
+    'Time spent serving /v1/chat/completions',
+    buckets=(.001, .005, .01, .05, .1, .5, 1, 2, 5, 10, 30)
+)
+
 # Pre-defined reasoning traces
 REASONING_TRACES = {
     "grep": {
@@ -26,6 +58,16 @@ REASONING_TRACES = {
     }
 }
 
+GREP_RESULTS_HEADER = "\n\nGrep results:\n"
+
+# Compile each trace pattern once; IGNORECASE saves lowercasing every prompt.
+# The canned responses never change, so their length and token estimate
+# (same len // 4 rule as estimate_tokens) are fixed too.
+for trace_data in REASONING_TRACES.values():
+    trace_data["compiled"] = re.compile(trace_data["pattern"], re.IGNORECASE)
+    trace_data["chars"] = len(trace_data["response"])
+    trace_data["tokens"] = trace_data["chars"] // 4
+
 GREP_RESPONSES = {
     "function": ["src/main.py:23:def main():", "src/utils.py:45:def helper_function():"],
     "class": ["src/models.py:5:class DataModel:", "src/handlers.py:18:class RequestHandler:"],
@@ -37,114 +79,205 @@ def estimate_tokens(text):
     return len(str(text)) // 4
 
 def simulate_timing(prompt_tokens, completion_tokens):
-    prefill_time = prompt_tokens / PREFILL_TOKENS_PER_SEC
-    decode_time = completion_tokens / DECODE_TOKENS_PER_SEC
+    prefill_time = prompt_tokens / SPEEDS["prefill"]
+    decode_time = completion_tokens / SPEEDS["decode"]
     return prefill_time + decode_time
 
+@lru_cache(maxsize=2048)
+def _select_trace_cached(prompt):
+    for trace_name, trace_data in REASONING_TRACES.items():
+        if trace_name != "default" and trace_data["compiled"].search(prompt):
+            return trace_data
+    return REASONING_TRACES["default"]
+
 def select_reasoning_trace(prompt):
     if not prompt:
-        return REASONING_TRACES["default"]["response"]
-    prompt_lower = str(prompt).lower()
-    for trace_name, trace_data in REASONING_TRACES.items():
-        if trace_name != "default" and re.search(trace_data["pattern"], prompt_lower):
-            return trace_data["response"]
-    return REASONING_TRACES["default"]["response"]
+        return REASONING_TRACES["default"]
+    return _select_trace_cached(str(prompt))
+
+# Words that make chat_completions append grep results to the reply
+_TRIGGER_RE = re.compile(r"grep|search|find", re.IGNORECASE)
 
+# Query keywords that select each GREP_RESPONSES category
+GREP_KEYWORDS = {
+    "function": ["function", "def", "method"],
+    "class": ["class", "classes"],
+}
+
+# One named group per category, built from GREP_KEYWORDS, so a single scan
+# reports every category hit (substring match, like `kw in query`)
+_KEYWORD_RE = re.compile(
+    "|".join(
+        f"(?P<{category}>{'|'.join(re.escape(kw) for kw in sorted(kws, key=len, reverse=True))})"
+        for category, kws in GREP_KEYWORDS.items()
+    ),
+    re.IGNORECASE
+)
+
+# Deterministic per query string, so repeated benchmark queries hit the cache
+@lru_cache(maxsize=1024)
 def grep_search(query):
     if not query:
         return "No query provided"
-    query_lower = str(query).lower()
+    hits = {m.lastgroup for m in _KEYWORD_RE.finditer(str(query))}
     results = []
-    keyword_map = {
-        "function": ["function", "def", "method"],
-        "class": ["class", "classes"],
-    }
-    for category, keywords in keyword_map.items():
-        if any(kw in query_lower for kw in keywords):
-            if category in GREP_RESPONSES:
-                results.extend(GREP_RESPONSES[category])
+    for category in GREP_RESPONSES:
+        if category in hits:
+            results.extend(GREP_RESPONSES[category])
     if not results:
         results = ["No matches found"]
     return "\n".join(results)
 
-@app.route('/v1/chat/completions', methods=['POST'])
-def chat_completions():
+# Text of the most recent user message; list contents keep their text parts
+def _extract_last_user_text(messages):
+    for msg in reversed(messages):
+        if msg.get('role') == 'user':
+            content = msg.get('content', '')
+            if isinstance(content, str):
+                return content
+            if isinstance(content, list):
+                return ' '.join(
+                    str(item['text']) if isinstance(item, dict) else item
+                    for item in content
+                    if isinstance(item, str) or (isinstance(item, dict) and 'text' in item)
+                )
+            return str(content) if content else ""
+    return ""
+
+# Body as parsed JSON, or None when it isn't valid JSON (like Flask's silent mode)
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+# Serialized chat reply with placeholder id/created, plus its completion
+# tokens. Everything else in the body is deterministic, so repeats of the same
+# (model, user message, prompt size) skip trace selection, grep and encoding.
+@lru_cache(maxsize=4096)
+def _render_chat_response(model, user_message, prompt_tokens):
+    trace = select_reasoning_trace(user_message)
+    if _TRIGGER_RE.search(user_message):
+        grep_results = grep_search(user_message)
+        response_text = f"{trace['response']}{GREP_RESULTS_HEADER}{grep_results}"
+        completion_tokens = (trace["chars"] + len(GREP_RESULTS_HEADER) + len(grep_results)) // 4
+    else:
+        response_text = trace["response"]
+        completion_tokens = trace["tokens"]
+    
+    body = orjson.dumps({
+        "id": "__ID__",
+        "object": "chat.completion",
+        "created": "__CREATED__",
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {
+                "role": "assistant",
+                "content": response_text
+            },
+            "finish_reason": "stop"
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    })
+    return body, completion_tokens
+
+# Fill in a rendered body's id and created. They are the first two keys, so
+# the first match of each placeholder is always the right one.
+def _stamp_response(body, now):
+    return body.replace(b'"__ID__"', b'"chatcmpl-%d"' % now, 1).replace(b'"__CREATED__"', b'%d' % now, 1)
+
+# Rendered reply for one chat request plus its simulated delay
+def _build_chat_response(data):
+    messages = data.get('messages', [])
+    
+    logger.debug("📥 Request with %d messages", len(messages))
+    
+    user_message = _extract_last_user_text(messages)
+    
+    # Plain-string contents (the common case) skip the per-message
+    # estimate_tokens call; list contents still go through str()
+    contents = [msg.get('content', '') for msg in messages]
+    if all(isinstance(content, str) for content in contents):
+        prompt_tokens = sum(len(content) // 4 for content in contents)
+    else:
+        prompt_tokens = sum(estimate_tokens(content) for content in contents)
+    
+    # A non-string model can't be a cache key; render it uncached
+    model = data.get('model', 'qwen-coder')
+    render = _render_chat_response if isinstance(model, str) else _render_chat_response.__wrapped__
+    body, completion_tokens = render(model, user_message, prompt_tokens)
+    
+    timing_delay = simulate_timing(prompt_tokens, completion_tokens)
+    logger.debug("⏱️  API delay: %.6fs (tokens: %d+%d)", timing_delay, prompt_tokens, completion_tokens)
+    return body, timing_delay
+
+@app.post('/v1/chat/completions')
+async def chat_completions(request: Request):
     request_start = time.time()
     try:
-        data = request.json
+        data = await read_json(request)
         if not data:
-            return jsonify({"error": "No JSON data provided"}), 400
+            return ORJSONResponse({"error": "No JSON data provided"}, status_code=400)
         
-        messages = data.get('messages', [])
+        body, timing_delay = _build_chat_response(data)
+        # Yield to the event loop so concurrent requests wait in parallel
+        await asyncio.sleep(timing_delay)
         
-        print(f"\n{'='*60}")
-        print(f"📥 Request at {time.strftime('%H:%M:%S')}")
+        body = _stamp_response(body, int(time.time()))
         
-        user_message = ""
-        for msg in reversed(messages):
-            if msg.get('role') == 'user':
-                content = msg.get('content', '')
-                if isinstance(content, list):
-                    texts = []
-                    for item in content:
-                        if isinstance(item, dict):
-                            if 'text' in item:
-                                texts.append(str(item['text']))
-                        elif isinstance(item, str):
-                            texts.append(item)
-                    user_message = ' '.join(texts)
-                else:
-                    user_message = str(content) if content else ""
-                break
+        request_end = time.time()
+        total_time = request_end - request_start
+        logger.info("✅ Total API time: %.6fs", total_time)
         
-        if 'grep' in str(user_message).lower() or 'search' in str(user_message).lower() or 'find' in str(user_message).lower():
-            grep_results = grep_search(user_message)
-            response_text = f"{select_reasoning_trace(user_message)}\n\nGrep results:\n{grep_results}"
-        else:
-            response_text = select_reasoning_trace(user_message)
+        REQUEST_SECONDS.observe(total_time)
         
-        prompt_tokens = sum(estimate_tokens(msg.get('content', '')) for msg in messages)
-        completion_tokens = estimate_tokens(response_text)
+        # Expose the server-side time so clients don't have to scrape logs
+        return Response(body, media_type="application/json", headers={'X-Mock-Elapsed-Ms': f"{total_time * 1000:.3f}"})
+    except Exception as e:
+        logger.exception("Error: %s", e)
+        return ORJSONResponse({"error": str(e)}, status_code=500)
+
+# Up to BATCH_MAX_REQUESTS chat requests in one call: {"requests": [...]} in,
+# {"responses": [...]} out. The sub-requests are simulated concurrently, so
+# the call waits for the slowest one instead of the sum of all delays.
+BATCH_MAX_REQUESTS = 100
+
+@app.post('/v1/chat/completions/batch')
+async def chat_completions_batch(request: Request):
+    request_start = time.time()
+    try:
+        data = await read_json(request)
+        batch = data.get('requests') if isinstance(data, dict) else None
+        if not isinstance(batch, list) or not batch:
+            return ORJSONResponse({"error": "'requests' must be a non-empty list"}, status_code=400)
+        if len(batch) > BATCH_MAX_REQUESTS:
+            return ORJSONResponse({"error": f"at most {BATCH_MAX_REQUESTS} requests per batch"}, status_code=400)
+        for i, sub_request in enumerate(batch):
+            if not isinstance(sub_request, dict) or not sub_request:
+                return ORJSONResponse({"error": f"requests[{i}] must be a JSON object"}, status_code=400)
         
-        timing_delay = simulate_timing(prompt_tokens, completion_tokens)
-        print(f"⏱️  API delay: {timing_delay:.6f}s (tokens: {prompt_tokens}+{completion_tokens})")
-        time.sleep(timing_delay)
+        built = [_build_chat_response(sub_request) for sub_request in batch]
+        await asyncio.sleep(max(timing_delay for _, timing_delay in built))
         
-        response = {
-            "id": f"chatcmpl-{int(time.time())}",
-            "object": "chat.completion",
-            "created": int(time.time()),
-            "model": data.get('model', 'qwen-coder'),
-            "choices": [{
-                "index": 0,
-                "message": {
-                    "role": "assistant",
-                    "content": response_text
-                },
-                "finish_reason": "stop"
-            }],
-            "usage": {
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "total_tokens": prompt_tokens + completion_tokens
-            }
-        }
+        now = int(time.time())
+        body = b'{"responses":[' + b','.join(_stamp_response(sub_body, now) for sub_body, _ in built) + b']}'
         
-        request_end = time.time()
-        total_time = request_end - request_start
-        print(f"✅ Total API time: {total_time:.6f}s")
-        print(f"{'='*60}\n")
+        total_time = time.time() - request_start
+        logger.info("✅ Batch of %d API time: %.6fs", len(built), total_time)
         
-        return jsonify(response)
+        return Response(body, media_type="application/json", headers={'X-Mock-Elapsed-Ms': f"{total_time * 1000:.3f}"})
     except Exception as e:
-        print(f"Error: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
-
-@app.route('/v1/models', methods=['GET'])
-def models():
-    return jsonify({
+        logger.exception("Error: %s", e)
+        return ORJSONResponse({"error": str(e)}, status_code=500)
+
+@app.get('/v1/models')
+async def models():
+    return {
         "object": "list",
         "data": [{
             "id": "qwen-coder",
@@ -152,17 +285,41 @@ def models():
             "created": int(time.time()),
             "owned_by": "mock-engine"
         }]
-    })
+    }
+
+@app.api_route('/admin/speeds', methods=['GET', 'POST'])
+async def admin_speeds(request: Request):
+    if request.method == 'POST':
+        data = await read_json(request) or {}
+        if not isinstance(data, dict):
+            return ORJSONResponse({"error": "body must be a JSON object"}, status_code=400)
+        updates = {}
+        for key in ("prefill", "decode"):
+            if key in data:
+                try:
+                    value = int(data[key])
+                except (TypeError, ValueError):
+                    return ORJSONResponse({"error": f"{key} must be an integer"}, status_code=400)
+                if value <= 0:
+                    return ORJSONResponse({"error": f"{key} must be positive"}, status_code=400)
+                updates[key] = value
+        SPEEDS.update(updates)
+        logger.info("⚙️  Speeds set: PREFILL=%d, DECODE=%d", SPEEDS['prefill'], SPEEDS['decode'])
+    return SPEEDS
+
+@app.get('/metrics')
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
-@app.route('/health', methods=['GET'])
-def health():
-    return jsonify({"status": "ok", "engine": "mock-engine"})
+@app.get('/health')
+async def health():
+    return {"status": "ok", "engine": "mock-engine"}
 
 if __name__ == '__main__':
     print("=" * 60)
     print("Mock Engine - INSTANT MODE (10M tokens/sec)")
     print("=" * 60)
     print(f"Listening on: http://0.0.0.0:8000")
-    print(f"Config: PREFILL={PREFILL_TOKENS_PER_SEC}, DECODE={DECODE_TOKENS_PER_SEC}")
+    print(f"Config: PREFILL={SPEEDS['prefill']}, DECODE={SPEEDS['decode']}")
     print("=" * 60)
-    app.run(host='0.0.0.0', port=8000, debug=False)
+    uvicorn.run(app, host='0.0.0.0', port=8000, access_log=False)
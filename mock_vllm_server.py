@@ -3,15 +3,21 @@ Mock vLLM Engine for qwen-code-ipc Testing
 Simulates OpenAI-compatible API with configurable token generation speeds
 """
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 import uvicorn
+import importlib.util
+import os
 import time
 import json
-from typing import Optional, List, Dict, Any
-from pydantic import BaseModel
+import orjson
+from typing import Optional, List, Dict, Any, Iterator
+from pydantic import BaseModel, ValidationError
 import asyncio
+import itertools
 import random
+import re
 
 # ============================================================================
 # CONFIGURATION - Adjust these to test different speeds
@@ -19,6 +25,9 @@ import random
 PREFILL_TOKENS_PER_SEC = 500  # Tokens/sec for prompt processing
 DECODE_TOKENS_PER_SEC = 50    # Tokens/sec for generation
 BASE_LATENCY_MS = 10          # Base network/processing latency
+STREAM_TICK_SECONDS = 0.02    # Streaming sends all tokens due in a tick at once
+# Server processes; the engine keeps no per-process state, so they scale freely
+WORKERS = int(os.environ.get("MOCK_VLLM_WORKERS", (os.cpu_count() or 1) * 2 + 1))
 
 # ============================================================================
 # REQUEST/RESPONSE MODELS
@@ -38,6 +47,12 @@ class ChatCompletionRequest(BaseModel):
     frequency_penalty: Optional[float] = 0.0
     presence_penalty: Optional[float] = 0.0
 
+# The handler parses the raw body itself, so the request schema is given to
+# OpenAPI by hand; Message is inlined since "#/$defs/..." refs don't resolve
+# inside an OpenAPI document
+CHAT_REQUEST_SCHEMA = ChatCompletionRequest.model_json_schema()
+CHAT_REQUEST_SCHEMA["properties"]["messages"]["items"] = CHAT_REQUEST_SCHEMA.pop("$defs")["Message"]
+
 # ============================================================================
 # PRE-DEFINED REASONING TRACES AND GREP RESPONSES
 # ============================================================================
@@ -101,30 +116,45 @@ CODE_ANALYSIS_FINDINGS = [
 # HELPER FUNCTIONS
 # ============================================================================
 
+# C-accelerated JSON string escaper (ASCII output, so it encodes for free)
+_ENCODE_STR = json.encoder.encode_basestring_ascii
+# Same word boundaries as str.split()
+_WORD_RE = re.compile(r"\S+")
+
 def count_tokens(text: str) -> int:
     """Approximate token count (rough estimate: ~4 chars per token)"""
     return len(text) // 4
 
+def _render_grep_response() -> str:
+    """Render one randomized grep response with a placeholder for the pattern"""
+    num_results = random.randint(3, 7)
+    selected_results = random.sample(GREP_RESPONSES, min(num_results, len(GREP_RESPONSES)))
+    
+    return REASONING_TRACES["grep_search"].format(
+        pattern=_PATTERN_SLOT,
+        num_results=num_results,
+        num_files=random.randint(2, 5),
+        results="\n".join(f"  {i+1}. {res}" for i, res in enumerate(selected_results))
+    )
+
+# Randomized grep responses rendered once at startup; requests only pick one
+# and drop in their search pattern
+_PATTERN_SLOT = "__PATTERN__"
+_GREP_RESPONSE_POOL = [_render_grep_response() for _ in range(32)]
+
 def generate_grep_response(user_message: str) -> str:
     """Generate a grep-like response based on the user message"""
     # Extract potential search pattern from message
     pattern = "function"  # Default
-    if "search" in user_message.lower() or "find" in user_message.lower():
+    message_lower = user_message.lower()
+    if "search" in message_lower or "find" in message_lower:
         words = user_message.split()
         for i, word in enumerate(words):
             if word.lower() in ["for", "search", "find"] and i + 1 < len(words):
                 pattern = words[i + 1].strip('",.:;')
                 break
     
-    num_results = random.randint(3, 7)
-    selected_results = random.sample(GREP_RESPONSES, min(num_results, len(GREP_RESPONSES)))
-    
-    return REASONING_TRACES["grep_search"].format(
-        pattern=pattern,
-        num_results=num_results,
-        num_files=random.randint(2, 5),
-        results="\n".join(f"  {i+1}. {res}" for i, res in enumerate(selected_results))
-    )
+    return random.choice(_GREP_RESPONSE_POOL).replace(_PATTERN_SLOT, pattern)
 
 def generate_code_analysis(user_message: str) -> str:
     """Generate a code analysis response"""
@@ -139,89 +169,134 @@ def generate_code_analysis(user_message: str) -> str:
 
 def generate_response(messages: List[Message]) -> str:
     """Generate appropriate response based on conversation context"""
-    last_message = messages[-1].content.lower()
+    content = messages[-1].content
+    last_message = content.lower()
     
     if any(word in last_message for word in ["grep", "search", "find", "pattern"]):
-        return generate_grep_response(messages[-1].content)
+        return generate_grep_response(content)
     elif any(word in last_message for word in ["analyze", "explain", "code", "implementation"]):
-        return generate_code_analysis(messages[-1].content)
+        return generate_code_analysis(content)
     else:
         return REASONING_TRACES["default"].format(
-            response=f"I understand you're asking about: {messages[-1].content[:100]}...\n\nLet me help with that."
+            response=f"I understand you're asking about: {content[:100]}...\n\nLet me help with that."
         )
 
+def iter_response_tokens(response_text: str) -> Iterator[str]:
+    """Yield each word's stream delta (word + space), JSON-escaped, as it is reached"""
+    for match in _WORD_RE.finditer(response_text):
+        yield _ENCODE_STR(match.group() + " ")
+
+def time_to_first_token(prompt_tokens: int) -> float:
+    """Base latency plus prefill time, in seconds"""
+    return BASE_LATENCY_MS / 1000.0 + prompt_tokens / PREFILL_TOKENS_PER_SEC
+
 async def simulate_generation_timing(prompt_tokens: int, completion_tokens: int):
     """Simulate realistic token generation timing"""
-    # Base latency
-    await asyncio.sleep(BASE_LATENCY_MS / 1000.0)
-    
-    # Prefill phase (process prompt)
-    prefill_time = prompt_tokens / PREFILL_TOKENS_PER_SEC
-    await asyncio.sleep(prefill_time)
-    
-    # Decode phase (generate tokens)
+    # Base latency + prefill phase + decode phase, as a single timer
     decode_time = completion_tokens / DECODE_TOKENS_PER_SEC
-    await asyncio.sleep(decode_time)
+    await asyncio.sleep(time_to_first_token(prompt_tokens) + decode_time)
 
 # ============================================================================
 # FASTAPI APP
 # ============================================================================
 
-app = FastAPI(title="Mock vLLM Engine", version="1.0.0")
+app = FastAPI(title="Mock vLLM Engine", version="1.0.0", default_response_class=ORJSONResponse)
+
+# Static endpoint bodies, encoded once at startup; the model's "created" is
+# the time this process started
+_ROOT_BODY = orjson.dumps({
+    "status": "running",
+    "engine": "mock_vllm",
+    "config": {
+        "prefill_tokens_per_sec": PREFILL_TOKENS_PER_SEC,
+        "decode_tokens_per_sec": DECODE_TOKENS_PER_SEC,
+        "base_latency_ms": BASE_LATENCY_MS
+    }
+})
+_MODELS_BODY = orjson.dumps({
+    "object": "list",
+    "data": [
+        {
+            "id": "qwen2.5-coder-32b-instruct",
+            "object": "model",
+            "created": int(time.time()),
+            "owned_by": "mock_vllm"
+        }
+    ]
+})
+_HEALTH_BODY = orjson.dumps({"status": "healthy", "engine": "mock_vllm"})
+
+# Fixed pieces of every stream: the chunk header (filled in per stream), the
+# final chunk's body and the end-of-stream sentinel
+_CHUNK_HEAD = 'data: {"id":"%s","object":"chat.completion.chunk","created":%d,"model":%s,'
+_FINAL_CHUNK_TAIL = '"choices":[{"index":0,"delta":{},"finish_reason":"stop"}]}\n\n'
+_DONE = b"data: [DONE]\n\n"
+
+# Keep caches and buffering proxies (nginx) from holding streamed tokens back
+_SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
 
 @app.get("/")
 async def root():
-    return {
-        "status": "running",
-        "engine": "mock_vllm",
-        "config": {
-            "prefill_tokens_per_sec": PREFILL_TOKENS_PER_SEC,
-            "decode_tokens_per_sec": DECODE_TOKENS_PER_SEC,
-            "base_latency_ms": BASE_LATENCY_MS
-        }
-    }
+    return Response(_ROOT_BODY, media_type="application/json")
 
 @app.get("/v1/models")
 async def list_models():
     """OpenAI-compatible models endpoint"""
-    return {
-        "object": "list",
-        "data": [
-            {
-                "id": "qwen2.5-coder-32b-instruct",
-                "object": "model",
-                "created": int(time.time()),
-                "owned_by": "mock_vllm"
-            }
-        ]
-    }
+    return Response(_MODELS_BODY, media_type="application/json")
 
-@app.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest):
+@app.post(
+    "/v1/chat/completions",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": CHAT_REQUEST_SCHEMA}}
+        }
+    }
+)
+async def chat_completions(http_request: Request):
     """OpenAI-compatible chat completions endpoint"""
     
-    # Calculate token counts
-    prompt_text = "\n".join([msg.content for msg in request.messages])
-    prompt_tokens = count_tokens(prompt_text)
-    
-    # Generate response
-    response_text = generate_response(request.messages)
-    completion_tokens = count_tokens(response_text)
+    # Validate straight from the raw body in pydantic-core (no intermediate
+    # dict from json.loads); errors keep FastAPI's usual 422 shape
+    try:
+        request = ChatCompletionRequest.model_validate_json(await http_request.body())
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]
+        )
     
-    # Measure actual generation time
-    start_time = time.time()
+    # One id and timestamp for the whole completion, streamed or not
+    created = int(time.time())
+    completion_id = f"chatcmpl-mock-{created}"
     
-    # Simulate realistic timing
-    await simulate_generation_timing(prompt_tokens, completion_tokens)
+    # Calculate token counts. Same count as for the newline-joined prompt,
+    # summed from the message lengths so the conversation is never copied
+    prompt_chars = sum(len(msg.content) for msg in request.messages)
+    prompt_tokens = (prompt_chars + max(len(request.messages) - 1, 0)) // 4
     
-    generation_time = time.time() - start_time
+    # Generate response. Inline on purpose: its lower()/in/split() calls hold
+    # the GIL, so a worker thread would not free the event loop anyway
+    response_text = generate_response(request.messages)
     
     # Non-streaming response
     if not request.stream:
-        return {
-            "id": f"chatcmpl-mock-{int(time.time())}",
+        completion_tokens = count_tokens(response_text)
+        
+        # Measure actual generation time
+        start_time = time.perf_counter()
+        
+        # Simulate realistic timing
+        await simulate_generation_timing(prompt_tokens, completion_tokens)
+        
+        generation_time = time.perf_counter() - start_time
+        total_tokens = prompt_tokens + completion_tokens
+        
+        # Returned as a response object so FastAPI hands the dict straight to
+        # orjson instead of first copying it through jsonable_encoder
+        return ORJSONResponse({
+            "id": completion_id,
             "object": "chat.completion",
-            "created": int(time.time()),
+            "created": created,
             "model": request.model,
             "choices": [
                 {
@@ -236,7 +311,7 @@ async def chat_completions(request: ChatCompletionRequest):
             "usage": {
                 "prompt_tokens": prompt_tokens,
                 "completion_tokens": completion_tokens,
-                "total_tokens": prompt_tokens + completion_tokens
+                "total_tokens": total_tokens
             },
             "system_fingerprint": f"mock_vllm_{DECODE_TOKENS_PER_SEC}tps",
             "x_timing": {
@@ -245,54 +320,48 @@ async def chat_completions(request: ChatCompletionRequest):
                 "prefill_tokens_per_sec": PREFILL_TOKENS_PER_SEC,
                 "decode_tokens_per_sec": DECODE_TOKENS_PER_SEC
             }
-        }
+        })
     
     # Streaming response
+    # Streaming only waits for the first token up front; decode time is
+    # paced out between chunks rather than slept before the first byte
     async def generate_stream():
+        await asyncio.sleep(time_to_first_token(prompt_tokens))
+        
         # Simulate token-by-token streaming
-        words = response_text.split()
-        for i, word in enumerate(words):
-            chunk = {
-                "id": f"chatcmpl-mock-{int(time.time())}",
-                "object": "chat.completion.chunk",
-                "created": int(time.time()),
-                "model": request.model,
-                "choices": [
-                    {
-                        "index": 0,
-                        "delta": {"content": word + " "},
-                        "finish_reason": None
-                    }
-                ]
-            }
-            yield f"data: {json.dumps(chunk)}\n\n"
+        tokens = iter_response_tokens(response_text)
+        # Every chunk is identical apart from its delta text, so the JSON
+        # around it is formatted once per stream
+        chunk_head = _CHUNK_HEAD % (completion_id, created, json.dumps(request.model))
+        chunk_prefix = chunk_head + '"choices":[{"index":0,"delta":{"content":'
+        chunk_suffix = '},"finish_reason":null}]}\n\n'
+        # Pace per tick rather than per token: each wakeup sends every token
+        # due in that tick, and each sleep targets the tick's scheduled time
+        # so serialization and scheduling lag don't accumulate
+        batch_size = max(1, int(DECODE_TOKENS_PER_SEC * STREAM_TICK_SECONDS))
+        tick = batch_size / DECODE_TOKENS_PER_SEC
+        stream_start = time.perf_counter()
+        for tick_index in itertools.count(1):
+            batch = list(itertools.islice(tokens, batch_size))
+            if not batch:
+                break
+            yield "".join(chunk_prefix + piece + chunk_suffix for piece in batch).encode()
             
-            # Simulate per-token delay
-            await asyncio.sleep(1.0 / DECODE_TOKENS_PER_SEC)
+            # Simulate decode time for this batch of tokens; under a
+            # millisecond, sleep(0) just yields instead of arming a timer
+            delay = stream_start + tick_index * tick - time.perf_counter()
+            await asyncio.sleep(delay if delay >= 0.001 else 0)
         
         # Send final chunk
-        final_chunk = {
-            "id": f"chatcmpl-mock-{int(time.time())}",
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": request.model,
-            "choices": [
-                {
-                    "index": 0,
-                    "delta": {},
-                    "finish_reason": "stop"
-                }
-            ]
-        }
-        yield f"data: {json.dumps(final_chunk)}\n\n"
-        yield "data: [DONE]\n\n"
+        yield (chunk_head + _FINAL_CHUNK_TAIL).encode()
+        yield _DONE
     
-    return StreamingResponse(generate_stream(), media_type="text/event-stream")
+    return StreamingResponse(generate_stream(), media_type="text/event-stream", headers=_SSE_HEADERS)
 
 @app.get("/health")
 async def health():
     """Health check endpoint"""
-    return {"status": "healthy", "engine": "mock_vllm"}
+    return Response(_HEALTH_BODY, media_type="application/json")
 
 # ============================================================================
 # MAIN
@@ -306,6 +375,7 @@ def main():
     print(f"   • Prefill Speed: {PREFILL_TOKENS_PER_SEC} tokens/sec")
     print(f"   • Decode Speed:  {DECODE_TOKENS_PER_SEC} tokens/sec")
     print(f"   • Base Latency:  {BASE_LATENCY_MS}ms")
+    print(f"   • Workers:       {WORKERS}")
     print("=" * 70)
     print(f"🌐 Server will run at: http://localhost:8000")
     print(f"📝 API Endpoint: http://localhost:8000/v1/chat/completions")
@@ -317,7 +387,19 @@ def main():
     print("\n⚡ To change speed, edit DECODE_TOKENS_PER_SEC at the top of this file")
     print("=" * 70 + "\n")
     
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
+    # Use the C event loop / HTTP parser when installed (uvicorn[standard])
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    uvicorn.run(
+        "mock_vllm_server:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=WORKERS,
+        loop=loop,
+        http=http,
+        log_level="warning",
+        access_log=False
+    )
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,13 @@
+#!/bin/bash
+# Serve mock_engine.py under uvicorn
+#
+# One worker on purpose: SPEEDS (POST /admin/speeds) and the /metrics
+# histogram live in process memory, so extra workers would each hold their
+# own copy. The handlers are async, so a single event loop already overlaps
+# every in-flight simulated delay. Override the bind with HOST=... PORT=...
+
+HOST=${HOST:-0.0.0.0}
+PORT=${PORT:-8000}
+
+cd "$(dirname "$0")"
+exec uvicorn mock_engine:app --host "$HOST" --port "$PORT" --workers 1 --no-access-log "$@"